@@ -0,0 +1,210 @@
+"""
+Hardware-free benchmark suite for the firmware
+
+Replays a trace (a synthetic storm when none is given) and measures main
+loop throughput, per-request latency, memory per sample and nowcast
+accuracy and update cost. Results can be
+saved as JSON and compared against a previous run to catch regressions:
+
+    python host/bench.py [TRACE] [--json OUT] [--baseline PREVIOUS] [--tolerance 0.25]
+"""
+import argparse
+import bisect
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from replay import Replay, Trace
+from synth import synthesize
+
+REQUESTS = {
+    'readings': 'GET /readings HTTP/1.1',
+    'export_csv': 'GET /export?format=csv HTTP/1.1',
+    'export_ndjson': 'GET /export?format=ndjson HTTP/1.1',
+    'page': 'GET / HTTP/1.1',
+    'forecast': 'GET /forecast HTTP/1.1',
+}
+REQUEST_ROUNDS = 200
+NOWCAST_HORIZONS = (15, 30, 60)
+# Forecasts are scored once per this many samples
+NOWCAST_EVERY = 20
+# Whether a larger value of a metric is an improvement
+HIGHER_IS_BETTER = {
+    'samples_per_second': True,
+}
+
+
+def bench_loop(trace):
+    replay = Replay(trace)
+    started = time.perf_counter()
+    samples = replay.run()
+    elapsed = time.perf_counter() - started
+    return replay, {
+        'samples': samples,
+        'samples_per_second': round(samples / elapsed, 1),
+        'i2c_reads_per_sample': round(replay.bus.reads / max(samples, 1), 2),
+        'i2c_writes_per_sample': round(replay.bus.writes / max(samples, 1), 2),
+    }
+
+
+def bench_requests(replay):
+    results = {}
+    for name, raw in REQUESTS.items():
+        timings = []
+        for _ in range(REQUEST_ROUNDS):
+            started = time.perf_counter()
+            replay.request(raw)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        results[name + '_mean_us'] = round(sum(timings) / len(timings) * 1e6, 1)
+        results[name + '_p95_us'] = round(timings[int(len(timings) * 0.95)] * 1e6, 1)
+    return results
+
+
+def bench_memory(trace):
+    replay = Replay(trace)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    samples = replay.run()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'retained_bytes_per_sample': round((current - baseline) / max(samples, 1), 1),
+        'peak_bytes': peak - baseline,
+    }
+
+
+def bench_nowcast(trace):
+    """
+    Score the nowcast against the rain that actually followed
+
+    Forecasts are compared with a persistence forecast that continues the
+    intensity of the last 15 minutes, and predicted tank inflow with the
+    volume the flow sensor recorded. The per-update cost is measured by
+    feeding the recorded samples to a fresh Nowcaster.
+    """
+    replay = Replay(trace)
+    samples = []
+    forecasts = []
+
+    def on_sample(replay):
+        logger = replay.data_logger
+        samples.append((logger.timestamps[-1], logger.rainfall_values[-1], logger.total_volume_values[-1]))
+        if len(samples) % NOWCAST_EVERY == 0:
+            forecast = logger.nowcast.forecast()
+            forecasts.append((samples[-1][0], forecast['rainfall'], forecast['inflow'], logger.rain_windows.get('15min', 0)))
+
+    replay.run(on_sample)
+    times = [sample[0] for sample in samples]
+
+    def sample_at(t):
+        return samples[max(bisect.bisect_right(times, t) - 1, 0)]
+
+    results = {}
+    for minutes in NOWCAST_HORIZONS:
+        nowcast_error = persistence_error = inflow_error = 0.0
+        scored = 0
+        key = f"{minutes}min"
+        for t, predicted, inflow, last_15min in forecasts:
+            if t + minutes * 60 > times[-1]:
+                break
+            start, end = sample_at(t), sample_at(t + minutes * 60)
+            actual = end[1] - start[1]
+            nowcast_error += abs(predicted[key] - actual)
+            persistence_error += abs(last_15min * minutes / 15 - actual)
+            inflow_error += abs(inflow[key] - max(end[2] - start[2], 0.0))
+            scored += 1
+        results[f'nowcast_mae_{key}_mm'] = round(nowcast_error / max(scored, 1), 3)
+        results[f'persistence_mae_{key}_mm'] = round(persistence_error / max(scored, 1), 3)
+        results[f'inflow_mae_{key}_l'] = round(inflow_error / max(scored, 1), 3)
+
+    # Learned inflow ratio against the volume per millimeter recorded over the replay
+    rain = samples[-1][1] - samples[0][1] if samples else 0
+    if rain > 0:
+        recorded = (samples[-1][2] - samples[0][2]) / rain
+        learned = replay.data_logger.nowcast.litres_per_mm
+        results['litres_per_mm_error'] = round(abs(learned - recorded) / max(recorded, 0.001), 3)
+
+    nowcaster = replay.firmware.Nowcaster(replay.firmware.catchment_area * replay.firmware.runoff_coefficient)
+    started = time.perf_counter()
+    for now, rainfall, total_volume in samples:
+        nowcaster.update(now, rainfall, total_volume)
+    results['nowcast_update_us'] = round((time.perf_counter() - started) / max(len(samples), 1) * 1e6, 2)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    List metrics that regressed by more than the tolerance
+
+    :param results: Metrics of this run
+    :param baseline: Metrics of a previous run
+    :param tolerance: Allowed relative change, e.g. 0.25 for 25%, and the allowed
+                      absolute change of metrics whose baseline is 0
+    :return: List of (metric, previous, current)
+    """
+    regressions = []
+    for metric, previous in baseline.items():
+        current = results.get(metric)
+        if current is None or metric in ('samples',) or metric.startswith('persistence_'):
+            continue
+        # A zero baseline (e.g. no I2C writes) has no relative change to measure
+        change = (current - previous) / abs(previous) if previous else current
+        if HIGHER_IS_BETTER.get(metric, False):
+            change = -change
+        if change > tolerance:
+            regressions.append((metric, previous, current))
+    return regressions
+
+
+def run(trace):
+    replay, results = bench_loop(trace)
+    results.update(bench_requests(replay))
+    results.update(bench_memory(trace))
+    results.update(bench_nowcast(trace))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hardware-free firmware benchmarks")
+    parser.add_argument('trace', nargs='?', help="Trace recorded on a station (default: synthetic storm)")
+    parser.add_argument('--hours', type=float, default=3, help="Length of the synthetic storm")
+    parser.add_argument('--read-faults', type=float, default=0.0, help="Failed read rate in the synthetic storm")
+    parser.add_argument('--json', help="Write the results to this file")
+    parser.add_argument('--baseline', help="Fail when results regress against this file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    path = args.trace
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.ndjson')
+        with os.fdopen(handle, 'w') as out:
+            synthesize(out, hours=args.hours, read_fault_rate=args.read_faults)
+    try:
+        results = run(Trace(path))
+    finally:
+        if args.trace is None:
+            os.remove(path)
+
+    for metric, value in results.items():
+        print(f"{metric:32} {value}")
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+    if args.baseline:
+        with open(args.baseline) as stream:
+            regressions = compare(results, json.load(stream), args.tolerance)
+        for metric, previous, current in regressions:
+            print(f"REGRESSION {metric}: {previous} -> {current}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
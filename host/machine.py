@@ -0,0 +1,107 @@
+"""
+Host-side stand-in for the MicroPython machine module
+
+Only the parts used by the firmware are provided. I2C transactions are
+forwarded to the bus set with attach() (a trace replayer), timers are
+scheduled by the attached clock and pin interrupts are fired by it.
+"""
+
+_bus = None
+_clock = None
+_pins = {}
+_timers = []
+
+
+def attach(bus=None, clock=None):
+    """
+    Connect the stand-ins to a simulated bus and clock
+
+    :param bus: Object providing readfrom_mem/writeto_mem
+    :param clock: Clock providing ms() for timer scheduling
+    """
+    global _bus, _clock
+    _bus = bus
+    _clock = clock
+    _pins.clear()
+    del _timers[:]
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state):
+    pass
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    def __init__(self, id, mode=-1, pull=-1):
+        self.id = id
+        self.mode = mode
+        self._value = 0
+        self._handler = None
+        _pins[id] = self
+
+    def irq(self, handler=None, trigger=IRQ_RISING):
+        self._handler = handler
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = 1 if value else 0
+
+    def pulse(self):
+        """
+        Simulate a rising edge on the pin
+        """
+        self._value = 1
+        if self._handler:
+            self._handler(self)
+        self._value = 0
+
+
+class SoftI2C:
+    def __init__(self, scl=None, sda=None, freq=400000, timeout=50000):
+        self.freq = freq
+
+    def readfrom_mem(self, addr, reg, length):
+        if _bus is None:
+            raise OSError(19)
+        return _bus.readfrom_mem(addr, reg, length)
+
+    def writeto_mem(self, addr, reg, data):
+        if _bus is None:
+            raise OSError(19)
+        _bus.writeto_mem(addr, reg, data)
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1):
+        self.id = id
+        self.mode = self.PERIODIC
+        self.period = 0
+        self.callback = None
+        self.due = None
+
+    def init(self, mode=PERIODIC, period=-1, callback=None):
+        self.mode = mode
+        self.period = period
+        self.callback = callback
+        self.due = (_clock.ms() if _clock else 0) + period
+        if self not in _timers:
+            _timers.append(self)
+
+    def deinit(self):
+        self.due = None
+        if self in _timers:
+            _timers.remove(self)
@@ -0,0 +1,29 @@
+"""
+Host-side stand-in for the MicroPython network module
+"""
+
+STA_IF = 0
+AP_IF = 1
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self.interface = interface
+        self._active = False
+        self._config = {}
+
+    def active(self, is_active=None):
+        if is_active is None:
+            return self._active
+        self._active = bool(is_active)
+
+    def config(self, *args, **kwargs):
+        if args:
+            return self._config.get(args[0])
+        self._config.update(kwargs)
+
+    def isconnected(self):
+        return self._active
+
+    def ifconfig(self):
+        return ('192.168.4.1', '255.255.255.0', '192.168.4.1', '0.0.0.0')
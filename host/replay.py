@@ -0,0 +1,263 @@
+"""
+Replay recorded I2C traffic and pulse timings through the firmware on CPython
+
+Traces are the NDJSON files written by recorder.Recorder on the device (or
+by synth.py). Register reads are answered with the most recent value the
+device returned at or before the current virtual time, so the firmware can
+be replayed even when its register access pattern has changed since the
+trace was recorded.
+"""
+import bisect
+import importlib
+import json
+import os
+import sys
+import time
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(HOST_DIR)
+for path in (REPO_DIR, HOST_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import machine
+
+
+class TraceEnd(Exception):
+    pass
+
+
+class Trace:
+    def __init__(self, path):
+        """
+        Load a trace file
+
+        :param path: NDJSON trace written by the recorder
+        """
+        self.start_time = 0
+        self.end = 0
+        self.pulses = []
+        self._reads = {}
+        with open(path) as stream:
+            for line in stream:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                self.end = max(self.end, record['t'])
+                op = record['op']
+                if op == 'start':
+                    self.start_time = record['time']
+                elif op == 'p':
+                    self.pulses.append((record['t'], record['pin']))
+                elif op == 'r':
+                    times, values = self._reads.setdefault((record['addr'], record['reg']), ([], []))
+                    times.append(record['t'])
+                    values.append(None if record.get('err') else bytes.fromhex(record['data']))
+        self.pulses.sort()
+
+    def read(self, addr, reg, length, now):
+        """
+        Get the register value the device returned at a given time
+
+        :param addr: I2C device address
+        :param reg: Register address
+        :param length: Number of bytes to read
+        :param now: Milliseconds since the start of the trace
+        :return: Register bytes, or None for a recorded read failure
+        """
+        if (addr, reg) not in self._reads:
+            raise OSError(19)
+        times, values = self._reads[(addr, reg)]
+        value = values[max(bisect.bisect_right(times, now) - 1, 0)]
+        if value is None:
+            return None
+        return (value + bytes(length))[:length]
+
+
+class VirtualClock:
+    def __init__(self, start_time=0, end=None, speed=None):
+        """
+        Drop-in replacement for the time module driving timers and pulses
+
+        :param start_time: Epoch seconds at virtual time zero
+        :param end: Milliseconds after which sleeping raises TraceEnd
+        :param speed: Replay speed-up factor, None to never really sleep
+        """
+        self.start_time = start_time
+        self.end = end
+        self.speed = speed
+        self.pulses = []
+        self._now = 0
+        self._next_pulse = 0
+
+    def ms(self):
+        return self._now
+
+    def time(self):
+        return self.start_time + self._now // 1000
+
+    def ticks_ms(self):
+        return self._now
+
+    def ticks_diff(self, new, old):
+        return new - old
+
+    def sleep_ms(self, ms):
+        self.advance(int(ms))
+
+    def sleep(self, seconds):
+        self.advance(int(seconds * 1000))
+
+    def advance(self, ms):
+        """
+        Move virtual time forward, firing due pulses and timers on the way
+
+        :param ms: Milliseconds to advance
+        """
+        target = self._now + ms
+        if self.speed:
+            time.sleep(ms / 1000 / self.speed)
+        while True:
+            due = [timer.due for timer in machine._timers if timer.due is not None]
+            next_timer = min(due) if due else None
+            next_pulse = self.pulses[self._next_pulse][0] if self._next_pulse < len(self.pulses) else None
+            if next_pulse is not None and next_pulse <= target and (next_timer is None or next_pulse <= next_timer):
+                self._now = max(self._now, next_pulse)
+                pin = machine._pins.get(self.pulses[self._next_pulse][1])
+                self._next_pulse += 1
+                if pin:
+                    pin.pulse()
+            elif next_timer is not None and next_timer <= target:
+                self._now = max(self._now, next_timer)
+                for timer in list(machine._timers):
+                    if timer.due is not None and timer.due <= self._now:
+                        timer.due = self._now + timer.period if timer.mode == machine.Timer.PERIODIC else None
+                        timer.callback(timer)
+            else:
+                break
+        self._now = target
+        if self.end is not None and self._now > self.end:
+            raise TraceEnd()
+
+
+class TraceBus:
+    def __init__(self, trace, clock):
+        """
+        I2C bus answering reads from a trace at the clock's virtual time
+
+        :param trace: Loaded Trace
+        :param clock: VirtualClock
+        """
+        self._trace = trace
+        self._clock = clock
+        self.reads = 0
+        self.writes = 0
+
+    def readfrom_mem(self, addr, reg, length):
+        self.reads += 1
+        value = self._trace.read(addr, reg, length, self._clock.ms())
+        if value is None:
+            raise OSError(5)
+        return value
+
+    def writeto_mem(self, addr, reg, data):
+        self.writes += 1
+
+
+class Connection:
+    def __init__(self):
+        """
+        In-memory client socket for driving handle_request()
+        """
+        self.chunks = []
+
+    def send(self, data):
+        self.chunks.append(data.encode() if isinstance(data, str) else bytes(data))
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def response(self):
+        return b''.join(self.chunks)
+
+
+class _Discard:
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class Replay:
+    def __init__(self, trace, speed=None, quiet=True):
+        """
+        Run the firmware main loop against a trace
+
+        :param trace: Loaded Trace or path to a trace file
+        :param speed: Replay speed-up factor, None to run as fast as possible
+        :param quiet: Discard the firmware's console output
+        """
+        self.trace = trace if isinstance(trace, Trace) else Trace(trace)
+        self.clock = VirtualClock(self.trace.start_time, self.trace.end, speed)
+        self.clock.pulses = self.trace.pulses
+        self.bus = TraceBus(self.trace, self.clock)
+        self.quiet = quiet
+        self.samples = 0
+        machine.attach(self.bus, self.clock)
+        # Fresh import so module state (flow totals, pin handlers) starts clean
+        sys.modules.pop('main', None)
+        self.firmware = importlib.import_module('main')
+        self.firmware.time = self.clock
+        self.sensor = self.firmware.RainfallSensor(machine.SoftI2C(scl=22, sda=21))
+        self.data_logger = self.firmware.DataLogger()
+
+    def run(self, on_sample=None):
+        """
+        Replay the whole trace
+
+        :param on_sample: Optional callback(replay) invoked after every save_reading
+        :return: Number of samples logged
+        """
+        save_reading = self.data_logger.save_reading
+
+        def counting_save_reading(*args, **kwargs):
+            save_reading(*args, **kwargs)
+            self.samples += 1
+            if on_sample:
+                on_sample(self)
+
+        self.data_logger.save_reading = counting_save_reading
+        stdout = sys.stdout
+        if self.quiet:
+            sys.stdout = _Discard()
+        try:
+            self.firmware.monitor(self.sensor, self.data_logger)
+        except TraceEnd:
+            pass
+        finally:
+            sys.stdout = stdout
+            del self.data_logger.save_reading
+        return self.samples
+
+    def request(self, raw):
+        """
+        Serve one HTTP request from the replayed state
+
+        :param raw: Raw HTTP request, e.g. 'GET /readings HTTP/1.1'
+        :return: Response bytes
+        """
+        conn = Connection()
+        self.firmware.handle_request(conn, raw, self.data_logger)
+        return conn.response()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python host/replay.py TRACE [PATH ...]")
+        sys.exit(2)
+    replay = Replay(sys.argv[1])
+    print(f"Replayed {replay.run()} samples")
+    for path in sys.argv[2:] or ['/readings']:
+        print(replay.request(f'GET {path} HTTP/1.1').decode())
@@ -0,0 +1,91 @@
+"""
+Generate synthetic storm traces in the recorder's NDJSON format
+
+Used when no trace recorded on a station is at hand. Tips follow a Poisson
+process whose rate tracks a smooth storm profile and the flow sensor pulses
+follow the runoff from a small catchment.
+"""
+import json
+import math
+import random
+import sys
+
+SENSOR_ADDR = 0x1D
+MM_PER_TIP = 0.28
+PULSES_PER_LITRE_MINUTE = 7.5
+FLOW_PIN = 4
+
+
+def _u32(value):
+    return (int(value) & 0xFFFFFFFF).to_bytes(4, 'little').hex()
+
+
+def _u16(value):
+    return (int(value) & 0xFFFF).to_bytes(2, 'little').hex()
+
+
+def storm_intensity(t, hours, peak):
+    """
+    Rainfall intensity of a single storm cell
+
+    :param t: Seconds since the start of the trace
+    :param hours: Trace length in hours
+    :param peak: Peak intensity in mm/h
+    :return: Intensity in mm/h
+    """
+    centre = hours * 3600 * 0.45
+    width = hours * 3600 * 0.15
+    return peak * math.exp(-((t - centre) / width) ** 2)
+
+
+def synthesize(stream, hours=3, peak=30.0, catchment=2.0, seed=0, start_time=0, sample_every=3,
+               read_fault_rate=0.0, blocked_funnel=False):
+    """
+    Write a synthetic trace
+
+    :param stream: Writable text stream
+    :param hours: Trace length in hours
+    :param peak: Peak rainfall intensity in mm/h
+    :param catchment: Catchment area feeding the flow sensor in square meters
+    :param seed: Random seed
+    :param start_time: Epoch seconds stored in the trace header
+    :param sample_every: Seconds between register snapshots
+    :param read_fault_rate: Probability of a snapshot recording a failed tip count read
+    :param blocked_funnel: Keep the tipping bucket dry while runoff still reaches the tank
+    :return: Number of tips generated
+    """
+    rng = random.Random(seed)
+    write = lambda record: stream.write(json.dumps(record) + '\n')
+    write({'t': 0, 'op': 'start', 'time': start_time})
+    write({'t': 0, 'op': 'r', 'addr': SENSOR_ADDR, 'reg': 0x00, 'data': 'c0004373'})
+    write({'t': 0, 'op': 'r', 'addr': SENSOR_ADDR, 'reg': 0x0A, 'data': _u16(0x1000)})
+    tips = 0
+    pulse_phase = 0.0
+    for second in range(int(hours * 3600)):
+        intensity = storm_intensity(second, hours, peak)
+        t = second * 1000
+        # Poisson tips at intensity / MM_PER_TIP per hour
+        if not blocked_funnel and rng.random() < intensity / MM_PER_TIP / 3600:
+            tips += 1
+        # Runoff reaches the tank a minute behind the rain, 1 mm on 1 m2 is 1 L
+        litres_per_minute = storm_intensity(second - 60, hours, peak) * catchment / 60
+        pulse_phase += litres_per_minute * PULSES_PER_LITRE_MINUTE
+        while pulse_phase >= 1:
+            pulse_phase -= 1
+            write({'t': t + rng.randrange(1000), 'op': 'p', 'pin': FLOW_PIN})
+        if second % sample_every == 0:
+            write({'t': t, 'op': 'r', 'addr': SENSOR_ADDR, 'reg': 0x14, 'data': _u32(tips)})
+            write({'t': t, 'op': 'r', 'addr': SENSOR_ADDR, 'reg': 0x10, 'data': _u32(tips * MM_PER_TIP * 10000)})
+            write({'t': t, 'op': 'r', 'addr': SENSOR_ADDR, 'reg': 0x18, 'data': _u16(second // 60)})
+            if rng.random() < read_fault_rate:
+                write({'t': t, 'op': 'r', 'addr': SENSOR_ADDR, 'reg': 0x14, 'len': 4, 'err': 1})
+    return tips
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python host/synth.py OUTPUT [HOURS] [PEAK_MM_PER_HOUR]")
+        sys.exit(2)
+    with open(sys.argv[1], 'w') as out:
+        count = synthesize(out, *[float(arg) for arg in sys.argv[2:4]])
+    print(f"Wrote {count} tips to {sys.argv[1]}")
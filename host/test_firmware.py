@@ -0,0 +1,215 @@
+"""
+Host-side checks of the firmware against brute-force references and replays
+
+    python -m pytest host
+"""
+import random
+
+import replay  # puts the repository and the stand-in machine module on sys.path
+import main
+
+WINDOWS = (300, 900, 3600, 86400, 200000)
+
+
+class ReferenceTimeline:
+    def __init__(self):
+        """
+        Brute-force tip history keeping every tip with its exact time
+        """
+        self.events = []
+        self.last_raw = None
+
+    def update(self, raw, now):
+        if self.last_raw is not None and raw > self.last_raw:
+            self.events.append((now, raw - self.last_raw))
+        self.last_raw = raw
+
+    def rainfall(self, window, now):
+        tips = sum(count for t, count in self.events if now - window < t <= now)
+        return round(tips * main.MM_PER_TIP, 2)
+
+
+def _random_walk(timeline, reference, rng, steps):
+    now = 1000
+    raw = rng.randrange(100)
+    for _ in range(steps):
+        roll = rng.random()
+        if roll < 0.02:
+            # Dry spell longer than one delta-encoded event can hold
+            now += rng.randrange(timeline.MAX_DT, 3 * timeline.MAX_DT)
+        else:
+            now += rng.choice((1, 3, 3, 3, 45, 600))
+        roll = rng.random()
+        if roll < 0.02:
+            # Counter reset
+            raw = rng.randrange(5)
+        elif roll < 0.04:
+            # Burst larger than one event can hold
+            raw += rng.randrange(timeline.MAX_TIPS, 3 * timeline.MAX_TIPS)
+        elif roll < 0.5:
+            raw += rng.randrange(4)
+        timeline.update(raw, now)
+        reference.update(raw, now)
+        yield now
+
+
+def test_timeline_matches_reference():
+    for seed in range(10):
+        rng = random.Random(seed)
+        timeline = main.TipTimeline(capacity=64, resolution=0)
+        reference = ReferenceTimeline()
+        checked = 0
+        for now in _random_walk(timeline, reference, rng, 600):
+            for window in WINDOWS:
+                if timeline.covers(window, now):
+                    assert timeline.rainfall(window, now) == reference.rainfall(window, now), (seed, now, window)
+                    checked += 1
+        # Evictions must not leave every window uncovered
+        assert checked > 600, seed
+
+
+def test_timeline_counts_tips_right_after_counter_reset():
+    timeline = main.TipTimeline(resolution=0)
+    timeline.update(50, 0)
+    timeline.update(52, 3)
+    timeline.update(0, 6)
+    timeline.update(4, 9)
+    assert timeline.rainfall(3600, 9) == round(6 * main.MM_PER_TIP, 2)
+
+
+def test_small_timeline_survives_eviction():
+    timeline = main.TipTimeline(capacity=32, resolution=0)
+    for i in range(500):
+        timeline.update(i, i * 10)
+    assert timeline.capacity == 2 * timeline.BLOCK
+    assert timeline.rainfall(300, 4990) == round(30 * main.MM_PER_TIP, 2)
+
+
+def test_coalesced_tips_keep_their_total():
+    timeline = main.TipTimeline(resolution=30)
+    timeline.update(0, 0)
+    for i in range(1, 101):
+        timeline.update(i, i * 3)
+    assert timeline.rainfall(3600, 300) == round(100 * main.MM_PER_TIP, 2)
+    assert len(timeline._tips) <= 100 * 3 // 30 + 1
+
+
+def test_export_keeps_rows_while_samples_arrive():
+    logger = main.DataLogger()
+    for i in range(main.MAX_VALUES):
+        logger.save_reading(i, i, i, 0.0, i, 0.0)
+    exported = []
+    for record in logger.iter_records():
+        exported.append(record)
+        logger.save_reading(99, 99, 99, 0.0, 99, 0.0)
+    assert [record[1] for record in exported] == list(range(main.MAX_VALUES))
+
+
+class FillingStream:
+    def __init__(self, room):
+        """
+        Text stream failing like a full filesystem once `room` characters are written
+        """
+        self.room = room
+        self.closed = False
+
+    def write(self, text):
+        if len(text) > self.room:
+            raise OSError(28)
+        self.room -= len(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class ConstantBus:
+    def readfrom_mem(self, addr, reg, length):
+        return bytes([5] + [0] * (length - 1))
+
+    def writeto_mem(self, addr, reg, data):
+        pass
+
+
+def test_full_trace_does_not_fail_sensor_reads():
+    from recorder import Recorder
+    stream = FillingStream(400)
+    recorder = Recorder(stream)
+    sensor = main.RainfallSensor(recorder.wrap_i2c(ConstantBus()))
+    for _ in range(20):
+        assert sensor.get_raw_data() == 5
+    recorder.flush()
+    assert sensor.read_errors == 0
+    assert not recorder.recording and stream.closed
+
+
+def test_trace_stops_at_size_limit():
+    from recorder import Recorder
+    stream = FillingStream(10 ** 6)
+    recorder = Recorder(stream, max_bytes=1000)
+    bus = recorder.wrap_i2c(ConstantBus())
+    for _ in range(100):
+        assert bus.readfrom_mem(0x1D, 0x14, 4)[0] == 5
+    assert not recorder.recording and stream.closed
+    assert 10 ** 6 - stream.room <= 1000
+
+
+def test_bench_flags_regressions_from_zero_baselines():
+    from bench import compare
+    assert compare({'i2c_writes_per_sample': 2.0}, {'i2c_writes_per_sample': 0.0}, 0.25) == [
+        ('i2c_writes_per_sample', 0.0, 2.0)]
+    assert compare({'i2c_writes_per_sample': 0.0}, {'i2c_writes_per_sample': 0.0}, 0.25) == []
+    assert compare({'readings_mean_us': 140.0}, {'readings_mean_us': 100.0}, 0.25) == [
+        ('readings_mean_us', 100.0, 140.0)]
+
+
+def _replay_storm(tmp_path, **storm):
+    from synth import synthesize
+    path = tmp_path / 'storm.ndjson'
+    with open(path, 'w') as out:
+        synthesize(out, **storm)
+    flags = []
+    replay.Replay(str(path)).run(lambda run: flags.append(run.data_logger.flag_values[-1]))
+    return flags
+
+
+def test_blocked_funnel_raises_flow_mismatch(tmp_path):
+    flags = _replay_storm(tmp_path, hours=1, blocked_funnel=True)
+    assert any(flag & main.QualityControl.FLOW_MISMATCH for flag in flags)
+
+
+def test_clean_storm_has_no_flow_mismatch(tmp_path):
+    flags = _replay_storm(tmp_path, hours=1)
+    assert not any(flag & main.QualityControl.FLOW_MISMATCH for flag in flags)
+
+
+
+class FixedClock:
+    def __init__(self):
+        """
+        Stand-in time module whose time() is set by the test
+        """
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+
+def test_nowcast_ignores_flagged_spike(monkeypatch):
+    clock = FixedClock()
+    monkeypatch.setattr(main, 'time', clock)
+    logger = main.DataLogger()
+    clean = main.Nowcaster(main.catchment_area * main.runoff_coefficient)
+    for now in range(0, 1800, 3):
+        rainfall = now * 0.001
+        # One sample reads 50 mm too high and later samples continue from it
+        flags = main.QualityControl.SPIKE if now == 600 else 0
+        offset = 50 if now >= 600 else 0
+        clock.now = now
+        logger.save_reading(rainfall + offset, 0, rainfall * 2, 0.0, 0, 0.0, flags=flags)
+        clean.update(now, rainfall, rainfall * 2)
+    assert abs(logger.nowcast.level - clean.level) < 0.01
+    assert abs(logger.nowcast.litres_per_mm - clean.litres_per_mm) < 0.01
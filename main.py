@@ -4,6 +4,11 @@ import socket
 import json
 import time
 from  time import sleep
+from array import array
+
+# Rainfall per bucket tip in millimeters (preset resolution of the SEN0575 sensor),
+# used by every calculation that works on tip counts
+MM_PER_TIP = 0.28
 
 class RainfallSensor:
     # Register addresses
@@ -30,6 +35,7 @@ class RainfallSensor:
         self._addr = addr
         self.vid = 0
         self.pid = 0
+        self.read_errors = 0
 
     def _read_register(self, reg, length):
         """
@@ -37,11 +43,12 @@ class RainfallSensor:
         
         :param reg: Register address
         :param length: Number of bytes to read
-        :return: List of register values
+        :return: List of register values (zeros on failure, counted in read_errors)
         """
         try:
             return list(self._i2c.readfrom_mem(self._addr, reg, length))
         except:
+            self.read_errors += 1
             return [0] * length
 
     def _write_register(self, reg, data):
@@ -171,34 +178,462 @@ class RainfallSensor:
                                         [data & 0xFF, (data >> 8) & 0xFF])
         except:
             return False
-    
 
 
+class TipTimeline:
+    # Events per checkpoint block
+    BLOCK = 32
+    # Largest gap / tip count a single delta-encoded event can hold
+    MAX_DT = 0xFFFF
+    MAX_TIPS = 0xFF
+
+    def __init__(self, capacity=3072, resolution=30, mm_per_tip=MM_PER_TIP):
+        """
+        Timestamped tip events derived from the raw tipping bucket count
+
+        Events are stored delta-encoded (2 byte time delta, 1 byte tip count)
+        with an absolute checkpoint every BLOCK events, so any rainfall window
+        is answered locally by a binary search over the checkpoints followed
+        by a short scan inside one block. Tips less than `resolution` seconds
+        after the previous event are added to it, so the default capacity
+        holds a full 24 hours of continuous rain (~10 KB).
+
+        :param capacity: Maximum number of stored events (oldest block is dropped when full,
+                         at least two blocks are kept)
+        :param resolution: Seconds within which tips are coalesced into one event
+        :param mm_per_tip: Rainfall per bucket tip in millimeters
+        """
+        self.capacity = max(capacity - capacity % self.BLOCK, 2 * self.BLOCK)
+        self.resolution = resolution
+        self.mm_per_tip = mm_per_tip
+        self._dt = array('H')
+        self._tips = array('B')
+        self._block_time = array('L')
+        self._block_tips = array('L')
+        self._last_time = 0
+        self._total = 0
+        self._last_raw = None
+        self._since = None
+
+    def update(self, raw, now):
+        """
+        Record tips from a new raw tipping bucket count
+
+        :param raw: Raw tip count as returned by get_raw_data()
+        :param now: Current time in seconds
+        :return: Number of new tips recorded
+        """
+        now = int(now)
+        if self._since is None:
+            self._since = now
+        if self._last_raw is None:
+            self._last_raw = raw
+            return 0
+        if raw < self._last_raw:
+            # Counter reset, count on from the new value
+            self._last_raw = raw
+            return 0
+        tips = raw - self._last_raw
+        self._last_raw = raw
+        if tips:
+            self._record(now, tips)
+        return tips
+
+    def _append(self, dt, tips):
+        if len(self._tips) >= self.capacity:
+            self._dt = self._dt[self.BLOCK:]
+            self._tips = self._tips[self.BLOCK:]
+            self._block_time = self._block_time[1:]
+            self._block_tips = self._block_tips[1:]
+            self._since = max(self._since, self._block_time[0])
+        self._last_time += dt
+        if len(self._tips) % self.BLOCK == 0:
+            self._block_time.append(self._last_time)
+            self._block_tips.append(self._total)
+            dt = 0
+        self._dt.append(dt)
+        self._tips.append(tips)
+        self._total += tips
+
+    def _record(self, now, tips):
+        if not self._tips:
+            self._last_time = now
+        gap = max(now - self._last_time, 0)
+        if self._tips and gap < self.resolution and self._tips[-1] + tips <= self.MAX_TIPS:
+            self._tips[-1] += tips
+            self._total += tips
+            return
+        # Long dry spells are bridged with empty events
+        while gap > self.MAX_DT:
+            self._append(self.MAX_DT, 0)
+            gap -= self.MAX_DT
+        while tips > self.MAX_TIPS:
+            self._append(gap, self.MAX_TIPS)
+            tips -= self.MAX_TIPS
+            gap = 0
+        self._append(gap, tips)
+
+    def _tips_until(self, t):
+        """
+        Cumulative tip count of all events at or before time t
+        """
+        lo, hi = 0, len(self._block_time)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._block_time[mid] <= t:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return self._block_tips[0] if self._block_tips else 0
+        block = lo - 1
+        when = self._block_time[block]
+        count = self._block_tips[block]
+        start = block * self.BLOCK
+        for i in range(start, min(start + self.BLOCK, len(self._tips))):
+            when += self._dt[i]
+            if when > t:
+                break
+            count += self._tips[i]
+        return count
+
+    def oldest(self):
+        """
+        Get time of the oldest stored event
+
+        :return: Time in seconds, or None when no events are stored
+        """
+        return self._block_time[0] if self._block_time else None
+
+    def covers(self, window, now):
+        """
+        Check whether a trailing window lies fully within the recorded history
+
+        History starts at the first update and moves forward when old events
+        are dropped.
+
+        :param window: Window length in seconds
+        :param now: Current time in seconds
+        :return: Boolean, False when the window rainfall is only a lower bound
+        """
+        return self._since is not None and int(now) - int(window) >= self._since
+
+    def rainfall(self, window, now):
+        """
+        Get rainfall within a trailing window
+
+        :param window: Window length in seconds
+        :param now: Current time in seconds
+        :return: Rainfall in millimeters
+        """
+        now = int(now)
+        tips = self._tips_until(now) - self._tips_until(now - int(window))
+        return round(tips * self.mm_per_tip, 2)
+
+    def intensity(self, window, now):
+        """
+        Get rolling rainfall intensity over a trailing window
+
+        :param window: Window length in seconds
+        :param now: Current time in seconds
+        :return: Intensity in millimeters per hour
+        """
+        return round(self.rainfall(window, now) * 3600 / window, 2)
+
+    def windows(self, now):
+        """
+        Get rainfall for all standard windows at once
+
+        :param now: Current time in seconds
+        :return: Dictionary of rainfall (mm) and intensity (mm/h), with 'partial'
+                 listing windows that reach back before the recorded history
+        """
+        windows = {
+            '5min': self.rainfall(300, now),
+            '15min': self.rainfall(900, now),
+            '1h': self.rainfall(3600, now),
+            '24h': self.rainfall(86400, now),
+            'intensity': self.intensity(900, now)
+        }
+        windows['partial'] = [key for key, length in (('5min', 300), ('15min', 900), ('1h', 3600), ('24h', 86400))
+                              if not self.covers(length, now)]
+        return windows
+
+
+class QualityControl:
+    # Flag bits stored with every sample
+    READ_FAIL = 0x01
+    OUT_OF_RANGE = 0x02
+    SPIKE = 0x04
+    NON_MONOTONIC = 0x08
+    STUCK = 0x10
+    FLOW_MISMATCH = 0x20
+    NAMES = ('read_fail', 'out_of_range', 'spike', 'non_monotonic', 'stuck', 'flow_mismatch')
+    # Flags marking the sample values themselves as untrustworthy
+    IMPLAUSIBLE = READ_FAIL | OUT_OF_RANGE | SPIKE | NON_MONOTONIC
+
+    def __init__(self, max_rainfall=9999.0, max_flow_rate=30.0, max_intensity=300.0,
+                 mm_per_tip=MM_PER_TIP, stuck_after=180, mismatch_after=600, min_runoff_rain=1.0):
+        """
+        Per-sample data quality checks with constant state
+
+        :param max_rainfall: Upper bound of the cumulative rainfall in millimeters
+        :param max_flow_rate: Upper bound of the flow rate in L/min
+        :param max_intensity: Largest plausible rainfall intensity in mm/h
+        :param mm_per_tip: Rainfall per bucket tip in millimeters
+        :param stuck_after: Seconds without the sensor working time advancing before flagging
+        :param mismatch_after: Seconds of flow without rain (or rain without flow) before flagging
+        :param min_runoff_rain: Rainfall in 15 minutes (mm) that should produce flow
+        """
+        self.max_rainfall = max_rainfall
+        self.max_flow_rate = max_flow_rate
+        self.max_intensity = max_intensity
+        self.mm_per_tip = mm_per_tip
+        self.stuck_after = stuck_after
+        self.mismatch_after = mismatch_after
+        self.min_runoff_rain = min_runoff_rain
+        self._last_time = None
+        self._last_rainfall = 0.0
+        self._last_tips = 0
+        self._last_working_time = None
+        self._working_since = 0
+        self._mismatch_since = None
+
+    def check(self, now, rainfall, tips, working_time, flow_rate, windows, read_failed=False):
+        """
+        Check one sample
+
+        :param now: Current time in seconds
+        :param rainfall: Cumulative rainfall in millimeters
+        :param tips: Raw tipping bucket count
+        :param working_time: Sensor working time in hours
+        :param flow_rate: Flow rate in L/min
+        :param windows: Rainfall windows from TipTimeline.windows()
+        :param read_failed: True when any I2C read of this sample failed
+        :return: Bitmask of flags, 0 for a clean sample
+        """
+        if read_failed:
+            # Values are zeros from _read_register, keep the last good state
+            return self.READ_FAIL
+        flags = 0
+        if not 0 <= rainfall <= self.max_rainfall or not 0 <= flow_rate <= self.max_flow_rate:
+            flags |= self.OUT_OF_RANGE
+
+        if self._last_time is not None:
+            if tips < self._last_tips or rainfall < self._last_rainfall:
+                flags |= self.NON_MONOTONIC
+            else:
+                allowed = self.max_intensity * (now - self._last_time) / 3600 + self.mm_per_tip
+                if (tips - self._last_tips) * self.mm_per_tip > allowed:
+                    flags |= self.SPIKE
+
+        if working_time != self._last_working_time:
+            self._last_working_time = working_time
+            self._working_since = now
+        elif now - self._working_since > self.stuck_after:
+            flags |= self.STUCK
+
+        flow_without_rain = flow_rate > 0 and windows.get('1h', 0) == 0
+        rain_without_flow = flow_rate == 0 and windows.get('15min', 0) >= self.min_runoff_rain
+        if flow_without_rain or rain_without_flow:
+            if self._mismatch_since is None:
+                self._mismatch_since = now
+            elif now - self._mismatch_since > self.mismatch_after:
+                flags |= self.FLOW_MISMATCH
+        else:
+            self._mismatch_since = None
+
+        self._last_time = now
+        self._last_rainfall = rainfall
+        self._last_tips = tips
+        return flags
+
+    @classmethod
+    def describe(cls, flags):
+        """
+        Get the names of the flags set in a bitmask
+
+        :param flags: Bitmask returned by check()
+        :return: List of flag names
+        """
+        return [name for bit, name in enumerate(cls.NAMES) if flags & (1 << bit)]
+
+
+class Nowcaster:
+    # Wet bins needed before the learned inflow ratio fully replaces the prior
+    LEARN_AFTER = 60
+    # Learned inflow ratio is kept within this factor of the prior
+    RATIO_RANGE = 4.0
+
+    def __init__(self, litres_per_mm, step=60, alpha=0.1, beta=0.1, phi=0.8, gamma=0.02):
+        """
+        Incremental rainfall nowcast with constant state
+
+        Rainfall is binned into fixed steps and every closed bin updates a
+        damped Holt (level + trend) model of the intensity. The tank inflow
+        per millimeter of rain is learned from exponentially smoothed rain
+        and volume increments and blended with the catchment prior until
+        LEARN_AFTER wet bins have been seen.
+
+        :param litres_per_mm: Prior tank inflow per millimeter of rain (catchment area in m2 times runoff coefficient)
+        :param step: Bin length in seconds
+        :param alpha: Level smoothing factor
+        :param beta: Trend smoothing factor
+        :param phi: Trend damping factor
+        :param gamma: Smoothing factor of the learned inflow ratio
+        """
+        self.step = step
+        self.alpha = alpha
+        self.beta = beta
+        self.phi = phi
+        self.gamma = gamma
+        self.level = 0.0
+        self.trend = 0.0
+        self.prior_litres_per_mm = litres_per_mm
+        self.litres_per_mm = litres_per_mm
+        self._wet_bins = 0
+        self._smoothed_rain = 0.0
+        self._smoothed_volume = 0.0
+        self._bin_start = None
+        self._bin_rain = 0.0
+        self._bin_volume = 0.0
+        self._last_rainfall = None
+        self._last_volume = None
+
+    def update(self, now, rainfall, total_volume, plausible=True):
+        """
+        Feed one sample
+
+        :param now: Current time in seconds
+        :param rainfall: Cumulative rainfall in millimeters
+        :param total_volume: Cumulative tank inflow in liters
+        :param plausible: False for a sample flagged by QualityControl, whose
+                          rainfall only becomes the new baseline
+        """
+        if self._bin_start is None:
+            self._bin_start = now
+        if self._last_rainfall is not None:
+            if plausible and rainfall >= self._last_rainfall:
+                self._bin_rain += rainfall - self._last_rainfall
+            if total_volume >= self._last_volume:
+                self._bin_volume += total_volume - self._last_volume
+        # Decreases are counter or volume resets, only take a new baseline
+        self._last_rainfall = rainfall
+        self._last_volume = total_volume
+        if now - self._bin_start < self.step:
+            return
+        # Rain collected over a gap is spread evenly across the steps it covers,
+        # and at most an hour of them is replayed
+        elapsed = (now - self._bin_start) // self.step
+        rain = self._bin_rain / elapsed
+        volume = self._bin_volume / elapsed
+        for _ in range(min(elapsed, 3600 // self.step)):
+            self._close_bin(rain, volume)
+        self._bin_rain = 0.0
+        self._bin_volume = 0.0
+        self._bin_start = now - (now - self._bin_start) % self.step
+
+    def _close_bin(self, rain, volume):
+        intensity = rain * 3600 / self.step
+        level = self.level
+        self.level = max(self.alpha * intensity + (1 - self.alpha) * (level + self.phi * self.trend), 0.0)
+        self.trend = self.beta * (self.level - level) + (1 - self.beta) * self.phi * self.trend
+        if rain > 0:
+            self._wet_bins += 1
+        self._smoothed_rain += self.gamma * (rain - self._smoothed_rain)
+        self._smoothed_volume += self.gamma * (volume - self._smoothed_volume)
+        if self._wet_bins and self._smoothed_rain > 0.001:
+            prior = self.prior_litres_per_mm
+            learned = self._smoothed_volume / self._smoothed_rain
+            learned = min(max(learned, prior / self.RATIO_RANGE), prior * self.RATIO_RANGE)
+            weight = min(self._wet_bins / self.LEARN_AFTER, 1.0)
+            self.litres_per_mm = prior + weight * (learned - prior)
+
+    def rainfall(self, horizon):
+        """
+        Get predicted rainfall over the coming horizon
 
+        :param horizon: Horizon in seconds
+        :return: Rainfall in millimeters
+        """
+        total = 0.0
+        damping = 0.0
+        for k in range(1, horizon // self.step + 1):
+            damping += self.phi ** k
+            total += max(self.level + damping * self.trend, 0.0)
+        return total * self.step / 3600
+
+    def forecast(self):
+        """
+        Get predicted rainfall and tank inflow for 15, 30 and 60 minutes
 
+        :return: Dictionary of intensity (mm/h), rainfall (mm) and inflow (L)
+        """
+        rainfall = {}
+        inflow = {}
+        for minutes in (15, 30, 60):
+            key = f"{minutes}min"
+            rain = self.rainfall(minutes * 60)
+            rainfall[key] = round(rain, 2)
+            inflow[key] = round(rain * self.litres_per_mm, 2)
+        return {
+            'intensity': round(self.level, 2),
+            'trend': round(self.trend * 3600 / self.step, 2),
+            'rainfall': rainfall,
+            'inflow': inflow,
+            'litres_per_mm': round(self.litres_per_mm, 2)
+        }
 
 
 # Initialize  variables
 pulse_count = 0
+# Pulses seen while flow is not being measured, checked against the rain by QualityControl
+idle_pulse_count = 0
 flow_rate = 0.0
 total_volume = 0.0
 calibration_factor = 7.5
+# Roof area feeding the tank (m2) and the share of rain reaching it, 1 mm on 1 m2 is 1 L
+catchment_area = 2.0
+runoff_coefficient = 0.8
 flow_sensor = Pin(4, Pin.IN)
 flow_sensor_enabled = False
 MAX_VALUES = 10
+EXPORT_BUFFER_SIZE = 512
+# Set to a file name, e.g. 'trace.ndjson', to record I2C traffic and flow pulses for host-side replay
+TRACE_FILE = None
+# Largest trace in bytes, recording stops there instead of filling the filesystem
+TRACE_MAX_BYTES = 256 * 1024
+# Seconds between trace flushes, a power cut loses at most this much and shorter intervals wear the flash
+TRACE_FLUSH_INTERVAL = 60
+EXPORT_FIELDS = ('time', 'rainfall', 'hour_rainfall', 'total_volume', 'flow_rate', 'flags')
 
 class DataLogger:
     def __init__(self):
+        self.timestamps = []
         self.rainfall_values = []
         self.hour_rainfall_values = []
         self.total_volume_values = []
         self.flow_rate_values = []
+        self.flag_values = []
+        # Whole samples for /export, one append and one pop per reading so the
+        # web server thread never sees a half-written row
+        self.records = []
         self.tips=0
         self.working_time=0.00
+        self.rain_windows={}
+        self.nowcast=Nowcaster(catchment_area * runoff_coefficient)
 
-    def save_reading(self, rainfall, hour_rainfall, total_volume,flow_rate,tips,working_time):
+    def save_reading(self, rainfall, hour_rainfall, total_volume,flow_rate,tips,working_time,windows=None,flags=0):
         self.tips=tips
         self.working_time=working_time
+        if windows is not None:
+            self.rain_windows=windows
+        now=int(time.time())
+        self.timestamps.append(now)
+        self.flag_values.append(flags)
+        # Flagged rainfall (spikes, resets, read failures) must not reach the
+        # model state or the learned inflow ratio, the flow sensor volume still counts
+        self.nowcast.update(now, rainfall, total_volume, not flags & QualityControl.IMPLAUSIBLE)
         if len(self.hour_rainfall_values)>0:
             self.rainfall_values.append(rainfall)
             self.hour_rainfall_values.append(hour_rainfall - self.hour_rainfall_values[-1])
@@ -209,8 +644,12 @@ class DataLogger:
             self.hour_rainfall_values.append(hour_rainfall)
             self.total_volume_values.append(total_volume)
             self.flow_rate_values.append(flow_rate)
+        self.records.append((now, rainfall, self.hour_rainfall_values[-1], total_volume, flow_rate, flags))
         
         if len(self.rainfall_values) > MAX_VALUES:
+            self.records.pop(0)
+            self.timestamps.pop(0)
+            self.flag_values.pop(0)
             self.rainfall_values.pop(0)
             self.hour_rainfall_values.pop(0)
             self.total_volume_values.pop(0)
@@ -218,18 +657,43 @@ class DataLogger:
 
     def get_readings(self):
         return {
+            'time': int(time.time()),
             'rainfall': self.rainfall_values,
             'hour_rainfall': self.hour_rainfall_values,
             'total_volume': self.total_volume_values,
             'flow_rate': self.flow_rate_values,
             'tips' : self.tips,
-            'working_time':self.working_time
+            'working_time':self.working_time,
+            'windows':self.rain_windows,
+            'flags':self.flag_values,
+            'quality':QualityControl.describe(self.flag_values[-1]) if self.flag_values else []
         }
 
+    def iter_records(self, start=None, end=None):
+        """
+        Iterate over stored samples within a time range
+
+        Timestamps are device clock seconds (time.time() on the station, counted
+        from 2000 on MicroPython unless the RTC has been set), not Unix time.
+
+        :param start: First timestamp to include (None for no lower bound)
+        :param end: Last timestamp to include (None for no upper bound)
+        :return: Generator of tuples ordered as EXPORT_FIELDS
+        """
+        # Iterate over a snapshot (at most MAX_VALUES rows), as a concurrent
+        # save_reading pops from the front of the list and would shift it
+        for record in tuple(self.records):
+            t = record[0]
+            if (start is not None and t < start) or (end is not None and t > end):
+                continue
+            yield record
+
 def pulse_counter(pin):
-    global pulse_count
+    global pulse_count, idle_pulse_count
     if flow_sensor_enabled:
         pulse_count += 1
+    else:
+        idle_pulse_count += 1
 
 flow_sensor.irq(trigger=Pin.IRQ_RISING, handler=pulse_counter)
 
@@ -245,6 +709,67 @@ def get_readings_json(data_logger):
     readings = data_logger.get_readings()
     return json.dumps(readings)
 
+def parse_query(request):
+    """
+    Parse the query string of an HTTP request line
+
+    :param request: Raw HTTP request
+    :return: Dictionary of query parameters
+    """
+    target = request.split(' ', 2)[1] if request.count(' ') >= 2 else ''
+    params = {}
+    if '?' in target:
+        for pair in target.split('?', 1)[1].split('&'):
+            if '=' in pair:
+                key, value = pair.split('=', 1)
+                params[key] = value
+    return params
+
+def export_lines(records, fmt):
+    """
+    Encode records one line at a time
+
+    :param records: Iterable of tuples ordered as EXPORT_FIELDS
+    :param fmt: 'csv' or 'ndjson'
+    :return: Generator of encoded lines
+    """
+    if fmt == 'csv':
+        yield (','.join(EXPORT_FIELDS) + '\n').encode()
+        for record in records:
+            yield (','.join([str(value) for value in record]) + '\n').encode()
+    else:
+        for record in records:
+            yield (json.dumps(dict(zip(EXPORT_FIELDS, record))) + '\n').encode()
+
+def _send_chunk(conn, data):
+    conn.sendall(('%x\r\n' % len(data)).encode())
+    conn.sendall(data)
+    conn.sendall(b'\r\n')
+
+def send_chunked(conn, lines, size=EXPORT_BUFFER_SIZE):
+    """
+    Send lines using HTTP chunked transfer encoding through a fixed buffer
+
+    :param conn: Client socket
+    :param lines: Iterable of encoded lines
+    :param size: Buffer size in bytes
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    used = 0
+    for line in lines:
+        if used and used + len(line) > size:
+            _send_chunk(conn, view[:used])
+            used = 0
+        if len(line) > size:
+            _send_chunk(conn, line)
+            continue
+        buf[used:used + len(line)] = line
+        used += len(line)
+    if used:
+        _send_chunk(conn, view[:used])
+    conn.sendall(b'0\r\n\r\n')
+
 def web_page():
     html = '''<!DOCTYPE html>
 <html lang="en">
@@ -677,42 +1202,86 @@ def start_webserver(data_logger):
         conn, addr = s.accept()
         try:
             request = conn.recv(1024).decode()
-            if 'GET /readings' in request:
-                response = get_readings_json(data_logger)
-                conn.send('HTTP/1.1 200 OK\n')
-                conn.send('Content-Type: application/json\n')
-                conn.send('Connection: close\n\n')
-                conn.sendall(response.encode())
-            elif 'POST /reset' in request:
-                # Reset all readings
-                data_logger.rainfall_values = []
-                data_logger.hour_rainfall_values = []
-                data_logger.total_volume_values = []
-                data_logger.flow_rate_values = []
-                global total_volume
-                total_volume = 0.0
-                
-                conn.send('HTTP/1.1 200 OK\n')
-                conn.send('Content-Type: text/plain\n')
-                conn.send('Connection: close\n\n')
-                conn.sendall('Reset successful'.encode())
-            else:
-                response = web_page()
-                conn.send('HTTP/1.1 200 OK\n')
-                conn.send('Content-Type: text/html\n')
-                conn.send('Connection: close\n\n')
-                conn.sendall(response.encode())
+            handle_request(conn, request, data_logger)
         except Exception as e:
             print("Error handling request:", e)
         finally:
             conn.close()
 
+def handle_request(conn, request, data_logger):
+    """
+    Route a single HTTP request and write the response
+    
+    :param conn: Client socket
+    :param request: Raw HTTP request
+    :param data_logger: DataLogger holding the readings
+    """
+    global total_volume
+    if 'GET /readings' in request:
+        response = get_readings_json(data_logger)
+        conn.send('HTTP/1.1 200 OK\n')
+        conn.send('Content-Type: application/json\n')
+        conn.send('Connection: close\n\n')
+        conn.sendall(response.encode())
+    elif 'GET /forecast' in request:
+        response = json.dumps(data_logger.nowcast.forecast())
+        conn.send('HTTP/1.1 200 OK\n')
+        conn.send('Content-Type: application/json\n')
+        conn.send('Connection: close\n\n')
+        conn.sendall(response.encode())
+    elif 'GET /export' in request:
+        params = parse_query(request)
+        fmt = params.get('format', 'csv')
+        try:
+            start = int(params['from']) if params.get('from') else None
+            end = int(params['to']) if params.get('to') else None
+        except ValueError:
+            fmt = None
+        if fmt not in ('csv', 'ndjson'):
+            conn.send('HTTP/1.1 400 Bad Request\n')
+            conn.send('Content-Type: text/plain\n')
+            conn.send('Connection: close\n\n')
+            conn.sendall('Expected format=csv|ndjson and numeric from/to'.encode())
+            return
+        conn.send('HTTP/1.1 200 OK\n')
+        conn.send('Content-Type: ' + ('text/csv' if fmt == 'csv' else 'application/x-ndjson') + '\n')
+        conn.send('Transfer-Encoding: chunked\n')
+        conn.send('Connection: close\n\n')
+        send_chunked(conn, export_lines(data_logger.iter_records(start, end), fmt))
+    elif 'POST /reset' in request:
+        # Reset all readings
+        data_logger.records = []
+        data_logger.timestamps = []
+        data_logger.flag_values = []
+        data_logger.rainfall_values = []
+        data_logger.hour_rainfall_values = []
+        data_logger.total_volume_values = []
+        data_logger.flow_rate_values = []
+        total_volume = 0.0
+        
+        conn.send('HTTP/1.1 200 OK\n')
+        conn.send('Content-Type: text/plain\n')
+        conn.send('Connection: close\n\n')
+        conn.sendall('Reset successful'.encode())
+    else:
+        response = web_page()
+        conn.send('HTTP/1.1 200 OK\n')
+        conn.send('Content-Type: text/html\n')
+        conn.send('Connection: close\n\n')
+        conn.sendall(response.encode())
+
 
 def main():
     print("Initializing Rainfall Sensor...")
-    sensor = RainfallSensor()
+    i2c = SoftI2C(scl=22, sda=21, freq=400000)
+    recorder = None
+    if TRACE_FILE:
+        from recorder import Recorder
+        recorder = Recorder(open(TRACE_FILE, 'w'), TRACE_MAX_BYTES)
+        i2c = recorder.wrap_i2c(i2c)
+        flow_sensor.irq(trigger=Pin.IRQ_RISING, handler=recorder.wrap_pulse(pulse_counter, 4))
+    sensor = RainfallSensor(i2c)
     print(sensor.begin())
-    global flow_sensor_enabled
     data_logger = DataLogger()
     
     import _thread
@@ -724,32 +1293,81 @@ def main():
     print("Sensor initialized successfully!")
     print("Connect to WiFi network 'RainfallMonitor' with password 'rainfall123'")
     print("Then visit http://192.168.4.1 in your web browser")
+    try:
+        monitor(sensor, data_logger, recorder)
+    finally:
+        if recorder:
+            recorder.close()
+
+def monitor(sensor, data_logger, recorder=None):
+    """
+    Sample the sensors every 3 seconds and log the readings
     
+    :param sensor: Initialized RainfallSensor
+    :param data_logger: DataLogger receiving the readings
+    :param recorder: Optional trace Recorder, flushed every TRACE_FLUSH_INTERVAL seconds
+    """
+    global flow_sensor_enabled, flow_rate, pulse_count, idle_pulse_count
     timer = Timer(0)
-    global prev
-    prev=sensor.get_rainfall_time(1)
+    # Rainfall windows are computed locally from tip events instead of
+    # writing I2C_REG_RAW_RAIN_HOUR and reading back I2C_REG_TIME_RAINFALL
+    timeline = TipTimeline()
+    quality = QualityControl()
+    errors=sensor.read_errors
+    tips=sensor.get_raw_data()
+    if sensor.read_errors == errors:
+        timeline.update(tips, time.time())
+    last_good=(0.0, 0, 0.0)
+    last_flush=time.time()
+    last_sample=time.time()
     
     while True:
-        curr_rain=sensor.get_rainfall_time(1)
+        errors=sensor.read_errors
         cumulative=sensor.get_rainfall()
         tips=sensor.get_raw_data()
         working_time=sensor.get_sensor_working_time()
+        read_failed=sensor.read_errors != errors
+        now=time.time()
+        if read_failed:
+            # Hold the last good values instead of logging zeros from a bus glitch
+            cumulative, tips, working_time = last_good
+        else:
+            timeline.update(tips, now)
+            last_good=(cumulative, tips, working_time)
+        windows=timeline.windows(now)
+        curr_rain=windows['1h']
+        # Flow is not measured without recent rain, but pulses arriving anyway
+        # (runoff past a blocked funnel) must still reach the mismatch check
+        observed_flow=flow_rate
+        if not flow_sensor_enabled:
+            observed_flow=idle_pulse_count / calibration_factor / max(now - last_sample, 1)
+        idle_pulse_count=0
+        last_sample=now
+        flags=quality.check(now, cumulative, tips, working_time, observed_flow, windows, read_failed)
+        if flags:
+            print(f"Quality Flags: {QualityControl.describe(flags)}")
         print(f"Sensor Working Time: {working_time} hours")
         print(f"Total Cumulative Rainfall: {cumulative} mm")
-        print(f"Rainfall in Last 1 Hour(s): {sensor.get_rainfall_time(1)} mm")
+        print(f"Rainfall in Last 1 Hour(s): {curr_rain} mm")
         print(f"Raw Tipping Bucket Count: {tips} tips")
         print("By https://github.com/rushikatabathuni/")
-        if curr_rain !=prev:
+        # Measure flow while runoff is expected, i.e. it rained within the last hour.
+        # The timer is only armed on the transition so no 1 s period is cut short.
+        if curr_rain > 0 and not flow_sensor_enabled:
+            pulse_count = 0
             flow_sensor_enabled = True
             timer.init(period=1000, mode=Timer.PERIODIC, callback=calculate_flow_rate)
-        else:
+        elif curr_rain == 0 and flow_sensor_enabled:
             flow_sensor_enabled = False
             timer.deinit()
-        prev=curr_rain
-        data_logger.save_reading(cumulative, curr_rain, total_volume, flow_rate,tips, round(working_time,2))
+            flow_rate = 0.0
+        data_logger.save_reading(cumulative, curr_rain, total_volume, flow_rate,tips, round(working_time,2), windows, flags)
+        if recorder and now - last_flush >= TRACE_FLUSH_INTERVAL:
+            # Keep the trace usable after a power cut or reset
+            recorder.flush()
+            last_flush=now
         time.sleep(3)
         
-#if __name__ == "__main__":
- #   main()
+if __name__ == "__main__":
+    main()
 
-main()
@@ -0,0 +1,183 @@
+import binascii
+import json
+import time
+from array import array
+
+import machine
+
+# Pulses buffered between two I2C transactions
+MAX_PENDING_PULSES = 64
+# Trace size in bytes at which recording stops, so the filesystem never fills up
+MAX_TRACE_BYTES = 256 * 1024
+
+
+def _ticks_ms():
+    return time.ticks_ms() if hasattr(time, 'ticks_ms') else int(time.time() * 1000)
+
+
+def _ticks_diff(new, old):
+    return time.ticks_diff(new, old) if hasattr(time, 'ticks_diff') else new - old
+
+
+def _hex(data):
+    return binascii.hexlify(bytes(data)).decode()
+
+
+class RecordingI2C:
+    def __init__(self, i2c, recorder):
+        """
+        I2C bus wrapper that records every transaction
+
+        :param i2c: Real I2C bus
+        :param recorder: Recorder receiving the transactions
+        """
+        self._i2c = i2c
+        self._recorder = recorder
+
+    def readfrom_mem(self, addr, reg, length):
+        try:
+            data = self._i2c.readfrom_mem(addr, reg, length)
+        except Exception:
+            self._recorder.write({'op': 'r', 'addr': addr, 'reg': reg, 'len': length, 'err': 1})
+            raise
+        self._recorder.write({'op': 'r', 'addr': addr, 'reg': reg, 'data': _hex(data)})
+        return data
+
+    def writeto_mem(self, addr, reg, data):
+        try:
+            self._i2c.writeto_mem(addr, reg, data)
+        except Exception:
+            self._recorder.write({'op': 'w', 'addr': addr, 'reg': reg, 'data': _hex(data), 'err': 1})
+            raise
+        self._recorder.write({'op': 'w', 'addr': addr, 'reg': reg, 'data': _hex(data)})
+
+
+class Recorder:
+    def __init__(self, stream, max_bytes=MAX_TRACE_BYTES):
+        """
+        Record I2C traffic and pulse timings as an NDJSON trace
+
+        Every line holds a millisecond offset 't' from the start of the
+        recording. Pulses are timestamped in the interrupt handler and only
+        written out with the next I2C transaction, so the handler never
+        touches the file. Recording stops for good when the trace reaches
+        max_bytes or the stream fails, e.g. on a full filesystem; the wrapped
+        bus and handlers keep working.
+
+        :param stream: Writable text stream, e.g. open('trace.ndjson', 'w')
+        :param max_bytes: Largest trace size in bytes
+        """
+        self._stream = stream
+        self.max_bytes = max_bytes
+        self.recording = True
+        self._bytes = 0
+        self._start = _ticks_ms()
+        self._pulses = array('L', [0] * MAX_PENDING_PULSES)
+        self._pulse_pins = array('B', [0] * MAX_PENDING_PULSES)
+        self._pending = 0
+        self._dropped = 0
+        self.write({'op': 'start', 'time': int(time.time())})
+
+    def _elapsed(self):
+        return _ticks_diff(_ticks_ms(), self._start)
+
+    def write(self, record):
+        """
+        Write a record, preceded by any pulses seen since the last one
+
+        :param record: Dictionary describing the event
+        """
+        if not self.recording:
+            return
+        try:
+            self._drain_pulses()
+            record['t'] = self._elapsed()
+            self._emit(record)
+        except Exception as e:
+            self.stop(e)
+
+    def _drain_pulses(self):
+        state = machine.disable_irq()
+        pulses = self._pulses[:self._pending]
+        pins = self._pulse_pins[:self._pending]
+        dropped = self._dropped
+        self._pending = 0
+        self._dropped = 0
+        machine.enable_irq(state)
+        for i in range(len(pulses)):
+            self._emit({'t': pulses[i], 'op': 'p', 'pin': pins[i]})
+        if dropped:
+            self._emit({'t': self._elapsed(), 'op': 'drop', 'count': dropped})
+
+    def _emit(self, record):
+        if not self.recording:
+            return
+        line = json.dumps(record) + '\n'
+        if self._bytes + len(line) > self.max_bytes:
+            self.stop(f"trace reached {self._bytes} bytes")
+            return
+        self._stream.write(line)
+        self._bytes += len(line)
+
+    def wrap_i2c(self, i2c):
+        """
+        Wrap an I2C bus so its transactions are recorded
+
+        :param i2c: Real I2C bus
+        :return: RecordingI2C
+        """
+        return RecordingI2C(i2c, self)
+
+    def wrap_pulse(self, handler, pin_id):
+        """
+        Wrap a pin interrupt handler so its pulses are recorded
+
+        :param handler: Original interrupt handler
+        :param pin_id: Pin number stored with the pulses
+        :return: Interrupt handler
+        """
+        def recording_handler(pin):
+            if self.recording:
+                if self._pending < MAX_PENDING_PULSES:
+                    self._pulses[self._pending] = self._elapsed()
+                    self._pulse_pins[self._pending] = pin_id
+                    self._pending += 1
+                else:
+                    self._dropped += 1
+            handler(pin)
+        return recording_handler
+
+    def flush(self):
+        """
+        Write pending pulses and flush the trace to storage
+        """
+        if not self.recording:
+            return
+        try:
+            self._drain_pulses()
+            self._stream.flush()
+        except Exception as e:
+            self.stop(e)
+
+    def stop(self, reason=None):
+        """
+        Stop recording and close the trace
+
+        :param reason: Why recording stopped, printed when given
+        """
+        if not self.recording:
+            return
+        self.recording = False
+        try:
+            self._stream.close()
+        except Exception:
+            pass
+        if reason is not None:
+            print(f"Trace recording stopped: {reason}")
+
+    def close(self):
+        """
+        Flush and close the trace
+        """
+        self.flush()
+        self.stop()